@@ -5,12 +5,149 @@ Authors:
     Sanyam Mehra (CS229 teaching staff): HW4 solutions
 """
 
+from collections import Counter
+
+import numba
 import numpy as np
+from scipy.linalg import solve
+from scipy.sparse import csr_matrix
 
 # handled type of obstacles
 OBSTACLE_TYPES = {'CACTUS_SMALL': 0, 'CACTUS_LARGE': 1, 'PTERODACTYL': 2}
 MAX_CONSECUTIVE_OBS = 3
 PTERODACTYL_HEIGHTS = [50, 75, 100]
+# tiny per-action bias breaking exact score ties in favor of the lower action index
+ACTION_TIE_BREAK = np.array([0., 1e-12])
+# Value Iteration sweeps run per compiled kernel call, between Anderson extrapolation steps
+VI_SWEEPS_PER_BLOCK = 5
+
+
+@numba.njit(cache=True)
+def _closest_state_idx(dt_mid, dy_mid, dy_pter_mid, is_pterodactyl, config, dt, y, isFail):
+    """Compiled kernel computing the index of the closest discretized state.
+
+    Args:
+        'dt_mid', 'dy_mid', 'dy_pter_mid' (np.array): midpoints of the discretization bins
+        'is_pterodactyl' (bool): whether the next obstacle is a Pterodactyl
+        'config' (float): obstacle configuration (flight level for a Pterodactyl)
+        'dt' (float): time to the next obstacle
+        'y' (float): height of the dino
+        'isFail' (bool): whether the Game is failed
+
+    Return:
+        'ind' (int): index of the closest discretized state
+    """
+    if isFail:
+        return 0
+
+    n_t = dt_mid.shape[0] + 1
+    n_y = dy_mid.shape[0] + 1
+
+    if is_pterodactyl:
+        i = np.searchsorted(dy_pter_mid, config)
+    else:
+        i = dy_pter_mid.shape[0] + 1
+
+    # closest discretized state indices: binary search against the bin midpoints
+    j = np.searchsorted(dt_mid, dt)
+    k = np.searchsorted(dy_mid, y)
+
+    return i*n_t*n_y + j*n_y + k + 2
+
+
+@numba.njit(fastmath=True, cache=True)
+def _value_iteration(indptr_nojump, indices_nojump, data_nojump, unvisited_nojump,
+                     indptr_jump, indices_jump, data_jump, unvisited_jump,
+                     visited_states, uniform_states, reward, value, gamma, tolerance, max_sweeps):
+    """Run up to 'max_sweeps' Value Iteration sweeps on the sparse transition model.
+
+    The whole Bellman sweep is fused in one compiled pass over the states: both sparse
+    matvecs (CSR arrays of the per-action transition probabilities), the max over actions,
+    the reward add and the infinity-norm convergence check.
+
+    The updates are Gauss-Seidel style: each state is overwritten in place, so later states
+    of the same sweep already use the improved values, which contracts faster than the
+    synchronous (Jacobi) update for the same fixed point. The uniform prior contribution
+    mean(value) is held fixed within a sweep.
+
+    Args:
+        'indptr_*', 'indices_*', 'data_*' (np.array): CSR arrays of the transition probabilities for each action
+        'unvisited_*' (np.array of bool): mask of the states never visited under each action
+        'visited_states' (np.array of int): indices of the states visited under at least one action
+        'uniform_states' (np.array of int): indices of the states never visited under either action
+        'reward' (np.array): state rewards
+        'value' (np.array): initial value function (warm-started from the previous simulation)
+        'gamma' (float): discount factor
+        'tolerance' (float): convergence criterium on the span of a sweep update
+        'max_sweeps' (int): maximum number of sweeps to run
+
+    Return:
+        'span_diff' (float): span seminorm (max - min) of the last sweep update ('value' is updated in place)
+
+    Remarks:
+        The span seminorm is the quantity actually contracted by the Bellman operator:
+        stopping on it reaches a near-optimal policy in about half the sweeps needed by
+        the infinity norm, since a constant shift of the value function does not change
+        the greedy policy.
+    """
+    span_diff = np.inf
+
+    for _ in range(max_sweeps):
+        # contribution of the uniform prior rows: 1/num_states * sum(value)
+        vmean = value.mean()
+        diff_max = -np.inf
+        diff_min = np.inf
+
+        for n in range(visited_states.shape[0]):
+            s = visited_states[n]
+            # Q(s,a) for the different actions
+            if unvisited_nojump[s]:
+                q_nojump = vmean
+            else:
+                q_nojump = 0.
+                for i in range(indptr_nojump[s], indptr_nojump[s+1]):
+                    q_nojump += data_nojump[i] * value[indices_nojump[i]]
+
+            if unvisited_jump[s]:
+                q_jump = vmean
+            else:
+                q_jump = 0.
+                for i in range(indptr_jump[s], indptr_jump[s+1]):
+                    q_jump += data_jump[i] * value[indices_jump[i]]
+
+            # Bellman update
+            new_value = reward[s] + gamma * max(q_nojump, q_jump)
+
+            # signed difference with previous value function
+            diff = new_value - value[s]
+            if diff > diff_max:
+                diff_max = diff
+            if diff < diff_min:
+                diff_min = diff
+
+            # Gauss-Seidel: write back in place so the later states of this sweep use the new value
+            value[s] = new_value
+
+        # states never visited under either action: both Q values reduce to the uniform contribution
+        q_uniform = gamma * vmean
+        for n in range(uniform_states.shape[0]):
+            s = uniform_states[n]
+            new_value = reward[s] + q_uniform
+
+            diff = new_value - value[s]
+            if diff > diff_max:
+                diff_max = diff
+            if diff < diff_min:
+                diff_min = diff
+
+            value[s] = new_value
+
+        # check for convergence of the span of the update
+        span_diff = diff_max - diff_min
+        if span_diff < tolerance:
+            break
+
+    return span_diff
 
 class AIAgent:
     """AI agent controlling the Dino.
@@ -23,7 +160,7 @@ class AIAgent:
         'args' (ArgumentParser): parser gethering all the Game parameters
         'gamma' (float): discount factor
         'eps' (float): epsilon-greedy coefficient
-        'mdp' (MDP): approximate MDP current parameters
+        'mdp_data' (dict): approximate MDP current parameters (property over the underlying arrays)
         
         'dino' (Dino): Dino controller
         
@@ -40,6 +177,7 @@ class AIAgent:
         self.gamma = args.gamma
         self.eps = args.eps
         self.tolerance = args.tolerance
+        self.solver = args.solver
         # initialize the approximate MDP parameters
         self.initialize_mdp_data()
         
@@ -87,8 +225,8 @@ class AIAgent:
         # update the approximate MDP with the simulation observations
         self.update_mdp_parameters()
         
-        # make the algorithm more greedy
-        self.eps += 0.01
+        # make the algorithm more greedy (fully greedy once eps reaches 1)
+        self.eps = min(self.eps + 0.01, 1.)
         
         # start a new simulation
         self.dino.start()
@@ -99,8 +237,8 @@ class AIAgent:
     def choose_action(self):
         """Choose the next action with an Epsilon-Greedy exploration strategy.
         """               
-        # epsilon-greedy strategy
-        if np.random.rand() < self.eps: 
+        # epsilon-greedy strategy (skip the random draw entirely once the strategy is fully greedy)
+        if self.eps >= 1. or np.random.rand() < self.eps:
             # choose greedily the best action
             self.action = self.best_action(self.state)
         else:
@@ -126,18 +264,9 @@ class AIAgent:
         """
         # get the index of the closest discretized state
         s = self.get_closest_state_idx(state)
-        
-        # value function if taking each action in the current state 
-        score_nothing = self.mdp_data['transition_probs'][s, 0, :].dot(self.mdp_data['value'])
-        score_jump = self.mdp_data['transition_probs'][s, 1, :].dot(self.mdp_data['value'])
-        
-        # DUCK ACTION NOT USED: CAN BEAT GAME WITHOUT DUCKING
-        #score_duck = self.mdp_data['transition_probs'][s, 2, :].dot(self.mdp_data['value']) 
 
-        # best action in the current state
-        action = (score_jump > score_nothing)*1
-        
-        return action
+        # the greedy policy is precomputed at the end of each simulation: the value function only changes there
+        return self._policy[s]
         
     def get_closest_state_idx(self, state, isFail=False):
         """Get the index of the closest discretized state.
@@ -153,22 +282,13 @@ class AIAgent:
             The state of the Dino is defined by: the time to the next obstacle (dt), the height of the dino (y), and if the obstacle is a Pterodactyl, its flight level.
             State 0 is a FAIL state ; State 1 is a NO_OBSTACLE state.
         """
-        # discretized state
-        dt_s, dy_s, dy_pter_s = self.mdp_data["state_discretization"]
-                
         if not state: # no obstacle created yet
             return 1
-        
-        if state['type'] == "PTERODACTYL":
-            i = np.argmin(abs(dy_pter_s - state['config']))
-        else:
-            i = dy_pter_s.size
-        
-        # closest discretized state indices
-        j = np.argmin(abs(dt_s - state['dt']))
-        k = np.argmin(abs(dy_s - state['y']))
-        
-        return (not isFail)*(i*dt_s.size*dy_s.size + j*dy_s.size + k + 2)
+
+        # unpack the state dict at the Python boundary, the compiled kernel works on typed scalars
+        return _closest_state_idx(self._dt_mid, self._dy_mid, self._dy_pter_mid,
+                                  state['type'] == "PTERODACTYL", float(state['config']),
+                                  float(state['dt']), float(state['y']), isFail)
         
     def initialize_mdp_data(self):
         """Save a attributes 'mdp_data' that contains all the parameters defining the approximate MDP.
@@ -179,33 +299,132 @@ class AIAgent:
         
         Initialization scheme:
             - Value function array initialized to 0
-            - Transition probability initialized uniformly: p(x'|x,a) = 1/num_states 
+            - Transition probability of unvisited (state, action) pairs kept at the uniform prior: p(x'|x,a) = 1/num_states
             - State rewards initialized to 0
+
+        Remarks:
+            The transition model is stored sparsely: counts as one {state: Counter of new_state} dict per action,
+            probabilities as one (num_states, num_states) CSR matrix per action.
+            Only the visited (state, action) pairs are materialized: the uniform prior rows are never stored,
+            their contribution to a Bellman backup is exactly mean(value).
         """
-        
+
         num_states = (1 + 1*len(PTERODACTYL_HEIGHTS) )*self.args.n_t*self.args.n_y + 2
-        
+
         # state discretization
         dt_s = np.linspace(0, self.args.max_dt, self.args.n_t)
         dy_s = np.linspace(0, self.args.max_y, self.args.n_y)
         dy_pter_s = np.array(PTERODACTYL_HEIGHTS).astype(float)
 
         # mdp parameters initialization
-        transition_counts = np.zeros((num_states, 2, num_states))
-        transition_probs = np.ones((num_states, 2, num_states)) / num_states
-        reward_counts = np.zeros((num_states, 2))
-        reward = np.zeros(num_states)
-        value = np.zeros(num_states)
-
-        self.mdp_data = {
-            'num_states': num_states,
-            'state_discretization': [dt_s, dy_s, dy_pter_s],
-            'transition_counts': transition_counts,
-            'transition_probs': transition_probs,
-            'reward_counts': reward_counts,
-            'reward': reward,
-            'value': value
+        # the fields are bound as attributes so the hot loops skip the dict lookups,
+        # 'mdp_data' stays available as a property for saving/loading
+        self._num_states = num_states
+        self._state_discretization = [dt_s, dy_s, dy_pter_s]
+        # counts are stored per action as {state: Counter of new_state}: increments are a
+        # plain hash update and memory stays O(observed transitions)
+        self._transition_counts = [{}, {}]
+        # float32 halves the bytes streamed per Bellman sweep; the counts are integers so
+        # the derived probabilities lose no meaningful precision
+        self._transition_probs = [csr_matrix((num_states, num_states), dtype=np.float32) for _ in range(2)]
+        # mask of the (state, action) pairs never visited: their transition probability stays uniform
+        self._unvisited = [np.ones(num_states, dtype=bool) for _ in range(2)]
+        # normalized transition rows cached per action, and the (state, action) pairs whose
+        # counts changed since the last reset (only those rows are re-normalized)
+        self._row_cache = [{}, {}]
+        self._dirty_sa = set()
+        # transitions observed during the current episode, applied to the counts in one batch at reset
+        self._transition_buffer = []
+        self._reward_counts = np.zeros((num_states, 2))
+        self._reward = np.zeros(num_states)
+        self._value = np.zeros(num_states)
+        # greedy policy, recomputed after every Value Iteration
+        self._policy = np.zeros(num_states, dtype=np.int64)
+
+        # span threshold guaranteeing an epsilon-optimal greedy policy for epsilon='tolerance'
+        self._span_tolerance = self.tolerance * (1 - self.gamma) / (2 * self.gamma)
+        # classic VI horizon: upper bound on the sweeps needed to reach the threshold,
+        # so the solver loop is bounded instead of open-ended
+        max_sweeps = int(np.ceil(np.log(self._span_tolerance * (1 - self.gamma)) / np.log(self.gamma))) + 1
+        self._max_blocks = -(-max_sweeps // VI_SWEEPS_PER_BLOCK)
+
+        # data derived from the state discretization and 'num_states'
+        self.initialize_derived_data()
+
+    def initialize_derived_data(self):
+        """Recompute the data derived from 'num_states' and 'state_discretization'.
+
+        Must be called again whenever those change (e.g. when loading a save produced
+        under different discretization arguments), so that state binning and the
+        preallocated solver scratch stay consistent with the stored MDP.
+        """
+        num_states = self._num_states
+        dt_s, dy_s, dy_pter_s = self._state_discretization
+
+        # midpoints of the discretization bins: searching them gives the closest discretized value
+        self._dt_mid = (dt_s[:-1] + dt_s[1:]) / 2
+        self._dy_mid = (dy_s[:-1] + dy_s[1:]) / 2
+        self._dy_pter_mid = (dy_pter_s[:-1] + dy_pter_s[1:]) / 2
+
+        # preallocated scratch reused at every reset, so the solver allocates nothing per call:
+        # CSR assembly buffers (one indptr per action, the built matrices keep a reference to it)
+        self._nnz = np.zeros(num_states, dtype=np.int32)
+        self._indptr = [np.zeros(num_states + 1, dtype=np.int32) for _ in range(2)]
+        # Value Iteration driver buffers (previous iterate, Anderson history and lstsq system)
+        self._value_old = np.empty(num_states)
+        self._history_v = np.empty((3, num_states))
+        self._history_r = np.empty((3, num_states))
+        self._value_acc = np.empty(num_states)
+        self._anderson_A = np.empty((num_states + 1, 3))
+        self._anderson_b = np.zeros(num_states + 1)
+
+    @property
+    def mdp_data(self):
+        """Gather the approximate MDP parameters in a dict (used for saving/loading)."""
+        # make sure the counts include the transitions of the current episode
+        self._flush_transition_buffer()
+
+        return {
+            'num_states': self._num_states,
+            'state_discretization': self._state_discretization,
+            'transition_counts': self._transition_counts,
+            'transition_probs': self._transition_probs,
+            'unvisited': self._unvisited,
+            'reward_counts': self._reward_counts,
+            'reward': self._reward,
+            'value': self._value,
+            'policy': self._policy
         }
+
+    @mdp_data.setter
+    def mdp_data(self, mdp_data):
+        num_states = mdp_data['num_states']
+        dt_s, dy_s, dy_pter_s = mdp_data['state_discretization']
+
+        # make sure the stored state count matches the stored discretization grid
+        expected_num_states = (1 + dy_pter_s.size)*dt_s.size*dy_s.size + 2
+        if num_states != expected_num_states:
+            raise ValueError("Inconsistent MDP parameters: num_states is {} but the "
+                             "state discretization defines {} states.".format(num_states, expected_num_states))
+
+        self._num_states = num_states
+        self._state_discretization = mdp_data['state_discretization']
+        self._transition_counts = mdp_data['transition_counts']
+        self._reward_counts = mdp_data['reward_counts']
+        self._reward = mdp_data['reward']
+        self._value = mdp_data['value']
+        # the derived fields can be rebuilt from the counts (see update_mdp_parameters)
+        self._transition_probs = mdp_data.get('transition_probs', [csr_matrix((num_states, num_states)) for _ in range(2)])
+        self._unvisited = mdp_data.get('unvisited', [np.ones(num_states, dtype=bool) for _ in range(2)])
+        self._policy = mdp_data.get('policy', np.zeros(num_states, dtype=np.int64))
+
+        # invalidate the normalized-row cache: every visited row of the new counts is dirty
+        self._row_cache = [{}, {}]
+        self._dirty_sa = {(s, a) for a in range(2) for s in self._transition_counts[a]}
+        self._transition_buffer = []
+
+        # rebuild the bin midpoints and the solver scratch for the loaded discretization
+        self.initialize_derived_data()
         
     def set_transition(self):
         """Update the approximate MDP with the given transition.
@@ -240,11 +459,73 @@ class AIAgent:
         # get the index of the closest discretized previous and new states
         s = self.get_closest_state_idx(state, False)
         new_s = self.get_closest_state_idx(new_state, isCrashed)
-                
-        # update the transition and the reward counts
-        self.mdp_data['transition_counts'][s, action, new_s] += 1
-        self.mdp_data['reward_counts'][new_s, 0] += reward
-        self.mdp_data['reward_counts'][new_s, 1] += 1
+
+        # buffer the transition: the counts are updated in one batch at the end of the episode,
+        # keeping the per-frame work to a single list append
+        self._transition_buffer.append((s, action, new_s, reward))
+
+    def _flush_transition_buffer(self):
+        """Apply the transitions buffered during the episode to the transition and reward counts.
+        """
+        if not self._transition_buffer:
+            return
+
+        for s, action, new_s, _ in self._transition_buffer:
+            self._transition_counts[action].setdefault(s, Counter())[new_s] += 1
+            # mark the row for re-normalization
+            self._dirty_sa.add((s, action))
+
+        # batch the scattered reward-count updates into two vectorized scatters
+        new_states = np.array([t[2] for t in self._transition_buffer], dtype=np.int64)
+        rewards = np.array([t[3] for t in self._transition_buffer], dtype=np.float64)
+        np.add.at(self._reward_counts[:, 0], new_states, rewards)
+        np.add.at(self._reward_counts[:, 1], new_states, 1)
+
+        self._transition_buffer.clear()
+
+    def run_policy_iteration(self):
+        """Compute the value function through Policy Iteration.
+
+        Each iteration evaluates the current greedy policy exactly by solving the linear
+        system (I - gamma*P_pi) v = r, then improves the policy against the new value
+        function; the loop stops when the policy is stable. PI needs far fewer iterations
+        than Value Iteration (typically under 10) at an O(num_states^3) cost per solve,
+        which is a good trade for this small state space.
+
+        Return:
+            'value' (np.array): value function of the converged policy
+        """
+        num_states = self._num_states
+        reward = self._reward
+        value = self._value
+
+        # densify the transition matrices, filling the unvisited rows with the uniform prior
+        P = []
+        for a in range(2):
+            P_a = self._transition_probs[a].toarray().astype(np.float64)
+            P_a[self._unvisited[a]] = 1. / num_states
+            P.append(P_a)
+
+        identity = np.eye(num_states)
+
+        # greedy policy with respect to the warm-started value function
+        policy = (P[1].dot(value) > P[0].dot(value))*1
+
+        while True:
+            # policy evaluation: exact solve instead of Bellman sweeps
+            P_pi = np.where((policy == 1)[:, np.newaxis], P[1], P[0])
+            value = solve(identity - self.gamma*P_pi, reward)
+
+            # policy improvement (ties prefer "do nothing", which makes the loop terminate)
+            new_policy = (P[1].dot(value) > P[0].dot(value))*1
+
+            # check for convergence
+            if np.array_equal(new_policy, policy):
+                break
+
+            policy = new_policy
+
+        return value
 
     def update_mdp_parameters(self):
         """Update the estimated MDP parameters (transition and reward functions) at the end of a simulation.
@@ -254,30 +535,134 @@ class AIAgent:
             Only observed transitions are updated.
             Only states with observed rewards are updated.
         """
-        temp = self.mdp_data['transition_probs'].copy()
-        # update the transition function
-        total_num_transitions = np.sum(self.mdp_data['transition_counts'], axis=-1)
-        visited_state_action_pairs = total_num_transitions > 0
-        self.mdp_data['transition_probs'][visited_state_action_pairs] = self.mdp_data['transition_counts'][visited_state_action_pairs] / total_num_transitions[visited_state_action_pairs, np.newaxis]
-
-        # update the reward function
-        visited_states = self.mdp_data['reward_counts'][:, 1] > 0
-        self.mdp_data['reward'][visited_states] = self.mdp_data['reward_counts'][visited_states, 0] / self.mdp_data['reward_counts'][visited_states, 1]
-
-        # update the value function through Value Iteration
-        while True:           
-            # Q(_,a) for the different actions
-            value_nojump = np.dot(self.mdp_data['transition_probs'][:,0,:], self.mdp_data['value'])
-            value_jump = np.dot(self.mdp_data['transition_probs'][:,1,:], self.mdp_data['value'])
+        # apply the transitions buffered during the episode
+        self._flush_transition_buffer()
 
-            # Bellman update
-            new_value = self.mdp_data['reward'] + self.gamma * np.maximum(value_nojump, value_jump)
-            
-            # difference with previous value function
-            max_diff = np.max(np.abs(new_value - self.mdp_data['value']))
+        # update the transition function: re-normalize only the rows whose counts changed
+        for s, a in self._dirty_sa:
+            row_counts = self._transition_counts[a][s]
+            cols = np.fromiter(row_counts.keys(), dtype=np.int32, count=len(row_counts))
+            counts = np.fromiter(row_counts.values(), dtype=np.float32, count=len(row_counts))
+            # keep the CSR indices of the row sorted
+            order = np.argsort(cols)
+            self._row_cache[a][s] = (cols[order], counts[order] / counts.sum())
+        self._dirty_sa.clear()
 
-            self.mdp_data['value'] = new_value
-            
-            # check for convergence
-            if max_diff < self.tolerance:
-                break
+        # assemble the per-action CSR matrices from the cached normalized rows
+        for a in range(2):
+            cache = self._row_cache[a]
+
+            nnz = self._nnz
+            nnz.fill(0)
+            for s in cache:
+                nnz[s] = cache[s][0].size
+            indptr = self._indptr[a]
+            np.cumsum(nnz, out=indptr[1:])
+
+            indices = np.empty(indptr[-1], dtype=np.int32)
+            data = np.empty(indptr[-1], dtype=np.float32)
+            for s, (cols, probs) in cache.items():
+                indices[indptr[s]:indptr[s+1]] = cols
+                data[indptr[s]:indptr[s+1]] = probs
+
+            self._unvisited[a] = nnz == 0
+            self._transition_probs[a] = csr_matrix((data, indices, indptr),
+                                                   shape=(self._num_states, self._num_states))
+
+        # update the reward function: single fused pass, rewards of unvisited states are left untouched
+        np.divide(self._reward_counts[:, 0], self._reward_counts[:, 1],
+                  out=self._reward, where=self._reward_counts[:, 1] > 0)
+
+        P_nojump, P_jump = self._transition_probs
+        unvisited_nojump, unvisited_jump = self._unvisited
+
+        if self.solver == "pi":
+            # update the value function through Policy Iteration
+            self._value = self.run_policy_iteration()
+        else:
+            # full Bellman backups are only needed for the states visited under at least one action
+            visited_any = ~(unvisited_nojump & unvisited_jump)
+            visited_states = np.flatnonzero(visited_any)
+            uniform_states = np.flatnonzero(~visited_any)
+
+            # update the value function through Value Iteration (compiled kernel), running the
+            # sweeps in short blocks with Anderson extrapolation between blocks
+            value = self._value
+            history_v = self._history_v
+            history_r = self._history_r
+            num_kept = 0
+            prev_diff = np.inf
+            accelerate = True
+
+            for _ in range(self._max_blocks):
+                np.copyto(self._value_old, value)
+                max_diff = _value_iteration(
+                    P_nojump.indptr, P_nojump.indices, P_nojump.data, unvisited_nojump,
+                    P_jump.indptr, P_jump.indices, P_jump.data, unvisited_jump,
+                    visited_states, uniform_states,
+                    self._reward, value, self.gamma, self._span_tolerance, VI_SWEEPS_PER_BLOCK)
+
+                # check for convergence
+                if max_diff < self._span_tolerance:
+                    break
+
+                # the last extrapolation overshot: discard it by restoring the plain iterate it
+                # replaced (the newest history entry) and finish this solve with plain sweeps only
+                if max_diff > prev_diff and num_kept > 0:
+                    value[:] = history_v[num_kept - 1]
+                    num_kept = 0
+                    accelerate = False
+                    continue
+                prev_diff = max_diff
+
+                if not accelerate:
+                    continue
+
+                # keep the last iterates and their block residuals in the preallocated history
+                if num_kept == history_r.shape[0]:
+                    history_v[:-1] = history_v[1:]
+                    history_r[:-1] = history_r[1:]
+                    num_kept -= 1
+                history_v[num_kept] = value
+                np.subtract(value, self._value_old, out=history_r[num_kept])
+                num_kept += 1
+
+                if num_kept >= 2:
+                    # Anderson step: combine the last iterates so the combined residual is minimal,
+                    # with the weights constrained to sum to 1 (weighted extra row in the lstsq)
+                    R = history_r[:num_kept]
+                    w = 100. * np.abs(R).max()
+                    A = self._anderson_A[:, :num_kept]
+                    A[:-1] = R.T
+                    A[-1] = w
+                    self._anderson_b[-1] = w
+                    alpha = np.linalg.lstsq(A, self._anderson_b, rcond=None)[0]
+
+                    np.dot(alpha, history_v[:num_kept], out=self._value_acc)
+                    if np.all(np.isfinite(self._value_acc)):
+                        value[:] = self._value_acc
+
+            # never hand an unconverged value to the policy precompute: if extrapolation burned
+            # the block budget, finish with plain sweeps (they provably converge within the
+            # horizon bound, so a single full-length kernel run suffices)
+            if max_diff >= self._span_tolerance:
+                _value_iteration(
+                    P_nojump.indptr, P_nojump.indices, P_nojump.data, unvisited_nojump,
+                    P_jump.indptr, P_jump.indices, P_jump.data, unvisited_jump,
+                    visited_states, uniform_states,
+                    self._reward, value, self.gamma, self._span_tolerance,
+                    self._max_blocks * VI_SWEEPS_PER_BLOCK)
+
+        # precompute the greedy policy for the whole next simulation with one sparse matvec per action
+        value = self._value
+        vmean = value.mean()
+        score_nothing = P_nojump.dot(value)
+        score_nothing[unvisited_nojump] = vmean
+        score_jump = P_jump.dot(value)
+        score_jump[unvisited_jump] = vmean
+
+        # DUCK ACTION NOT USED: CAN BEAT GAME WITHOUT DUCKING
+
+        # branchless argmax over the stacked scores, the bias encodes the tie-break precedence
+        scores = np.stack((score_nothing, score_jump)) - ACTION_TIE_BREAK[:, np.newaxis]
+        self._policy = np.argmax(scores, axis=0)
@@ -112,6 +112,11 @@ def add_RL_args(parser):
                         type=float,
                         default=1.,
                         help="Epsilon-greedy coefficient.")
+    parser.add_argument('--solver',
+                        type=str,
+                        default='vi',
+                        choices=('vi', 'pi'),
+                        help="Algorithm computing the value function: Value Iteration ('vi') or Policy Iteration ('pi').")
     parser.add_argument('--tolerance',
                         type=float,
                         default=0.01,
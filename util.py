@@ -8,6 +8,8 @@ import numpy as np
 import ujson as json
 import threading
 
+from collections import Counter
+
 def input_thread(inputs_list):
     """Save the user inputs.
     """
@@ -116,9 +118,20 @@ def save_agent(agent, out_filename):
         'agent' (AIAgent): AI agent to save
         'out_filename' (str): name of the output file
     """
+    # convert the np.arrays and sparse matrices to JSON-serializable lists
+    save_data = {
+        'num_states': agent.mdp_data['num_states'],
+        'state_discretization': [states.tolist() for states in agent.mdp_data['state_discretization']],
+        'transition_counts': [{str(s): dict(row_counts) for s, row_counts in counts.items()}
+                              for counts in agent.mdp_data['transition_counts']],
+        'reward_counts': agent.mdp_data['reward_counts'].tolist(),
+        'reward': agent.mdp_data['reward'].tolist(),
+        'value': agent.mdp_data['value'].tolist()
+    }
+
     with open(out_filename, "w") as out_file:
-        json.dump(agent.mdp_data, out_file)
-    
+        json.dump(save_data, out_file)
+
     print("The AI agent has been saved to: {}".format(out_filename))
     
 def load_agent(agent, in_filename):
@@ -130,15 +143,20 @@ def load_agent(agent, in_filename):
     """
     with open(in_filename, "r") as in_file:
         mdp_data = json.load(in_file)
-    
-    # convert all the list to np.arrays
+
+    # convert all the lists back to np.arrays and sparse matrices
     agent.mdp_data = {
         'num_states': mdp_data['num_states'],
         'state_discretization': [np.array(states_list) for states_list in mdp_data['state_discretization']],
-        'transition_counts': np.array(mdp_data['transition_counts']),
-        'transition_probs': np.array(mdp_data['transition_probs']),
+        'transition_counts': [{int(s): Counter({int(new_s): c for new_s, c in row_counts.items()})
+                               for s, row_counts in counts.items()}
+                              for counts in mdp_data['transition_counts']],
         'reward_counts': np.array(mdp_data['reward_counts']),
         'reward': np.array(mdp_data['reward']),
         'value': np.array(mdp_data['value'])
     }
+
+    # rebuild the transition probabilities from the loaded counts
+    agent.update_mdp_parameters()
+
     print("The AI agent has been loaded from: {}".format(in_filename))